@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# run the script: python -m parrot_project.decode_log logs/exp_1.bin
+"""
+Pretty-print a binary log written by the experiments with --binary-log.
+
+Each record is a LOG_RECORD (time_us, TEC, state id, node id, event), see utils.py.
+The output has the same layout as the text log.
+"""
+import argparse
+
+from .utils import (
+    LOG_HEADER,
+    LOG_RECORD,
+    NO_NODE,
+    STATES,
+    record_line
+)
+
+
+def decode(path: str):
+    """
+    Yield the (time_us, tec, state, node_id, event) records of a binary log file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    for time_us, tec, state_id, node_id, event in LOG_RECORD.iter_unpack(data):
+        yield time_us, tec, STATES[state_id], node_id, event.rstrip(b"\0").decode("utf-8")
+
+
+def format_record(time_us: int, tec: int, state, node_id: int, event: str) -> str:
+    """
+    Format a decoded record as the matching text log line.
+    """
+    if node_id == NO_NODE:
+        return record_line(time_us, event)
+    return record_line(time_us, event, tec, state.value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("log_file", help="binary log file (logs/exp_*.bin)")
+    args = parser.parse_args()
+
+    print(LOG_HEADER)
+    print("-" * len(LOG_HEADER))
+    for record in decode(args.log_file):
+        print(format_record(*record))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Closed-form trace of Parrot Paper Experiment 1.
+
+The experiment is deterministic: every round starts with both ECUs at the same TEC,
+the collision snowball takes both of them to ERROR_PASSIVE, then the defender and
+the attacker recover (one success every GAP_US) until they are ACTIVE again at TEC 127.
+run() computes the TEC history and the log lines of all the rounds directly,
+without the event queue, and gives the same output as CanBus.execute.
+"""
+import numpy as np
+
+from ..utils import (
+    ErrorStates,
+    GAP_US,
+    MAX_ROUNDS,
+    log_time,
+    log_info,
+    log_event,
+    state_change_line
+)
+
+
+def _state(tec: int) -> str:
+    """
+    Name of the error state of a node with the given TEC.
+    """
+    if tec >= 256:
+        return ErrorStates.BUS_OFF.value
+    return (ErrorStates.ERROR_PASSIVE if tec >= 128 else ErrorStates.ACTIVE).value
+
+
+def _round(tec: int, gap_us: int, attacker: str, defender: str):
+    """
+    Trace of one round starting with both nodes at the given TEC, relative to its start.
+    Returns (lines, time, attacker TEC, defender TEC, duration): lines is a list of
+    (time or None, text) pairs, the text being the log line after the time column
+    (or the whole line when time is None), without the round start line.
+    """
+    info = log_info(tec, _state(tec))
+    lines = [(0, log_event("Attacker sends spoofed frame", info)),
+             (0, log_event("Defender sends D-frame", info))]
+
+    # round start, then one collision every gap_us up to ERROR_PASSIVE
+    steps = max(1, -(-(128 - tec) // 8))
+    i = np.arange(steps)
+    ramp = np.concatenate(([tec], tec + 8 * i))
+    times = [np.concatenate(([0], i * gap_us))]
+    atts = [ramp]
+    defs = [ramp]
+    t = (steps - 1) * gap_us
+    top = tec + 8 * steps
+    lines.append((t, log_event(f"Collision snowball x{steps}")))
+    lines.append((None, state_change_line(attacker, _state(top), top)))
+    lines.append((None, state_change_line(defender, _state(top), top)))
+
+    # defender then attacker recover one TEC per success, down to 127
+    k = top - 127
+    j = np.arange(1, k + 1)
+    down = top - j # TEC after each success
+    for name, event, att, dfn in ((defender, "Defender recovers send", np.full(k, top), down + 1),
+                                  (attacker, "Attacker recovers send", down + 1, np.full(k, 127))):
+        times.append(t + j * gap_us)
+        atts.append(att)
+        defs.append(dfn)
+        lines.extend((t + n * gap_us, log_event(event, log_info(tec_n, _state(tec_n))))
+                     for n, tec_n in zip(j.tolist(), down.tolist()))
+        lines.append((None, state_change_line(name, _state(127), 127)))
+        t += k * gap_us
+    return lines, np.concatenate(times), np.concatenate(atts), np.concatenate(defs), t + gap_us
+
+
+def run(max_rounds: int = MAX_ROUNDS, gap_us: int = GAP_US,
+        attacker: str = "[E] ATTACKER", defender: str = "[A] DEFENDER"):
+    """
+    Compute max_rounds rounds of Experiment 1.
+    Returns (time, attacker TEC, defender TEC, lines): the TEC history sampled before
+    every event, as numpy arrays, and the log lines (without the header).
+    """
+    times, atts, defs = [], [], []
+    lines = []
+    rounds = {} # round trace by starting TEC: only the first round differs
+    t = 0
+    tec = 0 # TEC of both nodes at the start of the round
+    for r in range(1, max_rounds + 1):
+        if tec not in rounds:
+            rounds[tec] = _round(tec, gap_us, attacker, defender)
+        round_lines, round_time, round_att, round_def, duration = rounds[tec]
+        lines.append(log_time(t) + log_event(f"=== ROUND {r} START ==="))
+        lines.extend(text if dt is None else log_time(t + dt) + text
+                     for dt, text in round_lines)
+        times.append(t + round_time)
+        atts.append(round_att)
+        defs.append(round_def)
+        t += duration
+        tec = 127
+
+    # the last round start only finds that the rounds are over
+    times.append([t])
+    atts.append([tec])
+    defs.append([tec])
+    return (np.concatenate(times).astype(np.int64), np.concatenate(atts).astype(np.int16),
+            np.concatenate(defs).astype(np.int16), lines)
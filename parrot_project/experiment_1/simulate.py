@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# run the script: python -m parrot_project.experiment_1.simulate
+# run the script: python -m parrot_project.experiment_1.simulate [-v] [--no-plot] [--binary-log] [--record-interval N] [--closed-form]
 """
 Simulate Parrot Paper Experiment 1 in an event-driven fashion using heapq.
 
@@ -11,30 +11,39 @@ This triggers the attacker to send spoofing messages again.
 
 This cycle repeats for MAX_ROUNDS rounds (just to show that this situation keeps repeating 
 and the ECUs never reach BUS_OFF state).
-All events (collision, recovery, state changes) are logged to console and file,
+All events (collision, recovery, state changes) are logged to file (and to console with -v),
 and TEC history is recorded and plotted at the end.
 
 From this experiment we can understand that the 2 ECUs tested have 0% bus off state
 That is because the Defender Alice follows the 31 us gap required by the software
 but Eve doesn't because she is a malicious attacker thats why Alice cant make it to put her unit toBUS-OFF
 """
+import argparse
 import heapq
-import matplotlib.pyplot as plt
 
+import numpy as np
+
+from . import closed_form
 from  ..utils import (
     ErrorStates,
     CanNode,
     CanBusBase,
-    ASSISTANT_GAP_US,
-    ATTACKER_PERIOD_US,
     GAP_US,
-    MAX_ROUNDS
+    MAX_ROUNDS,
+    STATE_CHANGE,
+    state_change_line
 )
 
 # Can Bus simulation
 class CanBus(CanBusBase):
-    def __init__(self):
-        super().__init__(log_file="exp_1.txt")
+    __slots__ = ("plot",)
+    _figure = None # (figure, axes, lines) shared by every run, see __make_plot
+
+    def __init__(self, verbose: bool = False, plot: bool = True, binary_log: bool = False,
+                 record_interval: int = 1):
+        super().__init__(log_file="exp_1.txt", verbose=verbose, binary_log=binary_log,
+                         record_interval=record_interval)
+        self.plot = plot
         # since this exp doesnt arrive to BUS OFF, we use rounds
         # to run the script a couple of times, right now it is set to 3.
         self.rounds = 0
@@ -42,38 +51,110 @@ class CanBus(CanBusBase):
     def execute(self):
         # schedule first round at time 0.
         self.schedule(0, self.__start_round)
-        while self.events:
-            t, _, callback = heapq.heappop(self.events)
-            self.time_us = t
-            # record before each event
-            self.record_history()
-            callback()
-        self.log_f.close()
+        # local references for the hot loop
+        heappop = heapq.heappop
+        events = self.events
+        now = self._now
+        next_now = now.popleft
+        record_history = self.record_history
+        interval = self.record_interval
+        with self:
+            while now or events:
+                if not now:
+                    # move on to the next timestamp and queue all its events
+                    t = events[0][0]
+                    self.time_us = t
+                    while events and events[0][0] == t:
+                        now.append(heappop(events)[2])
+                callback = next_now()
+                # record before each event (every record_interval events, -1: never)
+                if interval > 0:
+                    if self._n_events % interval == 0:
+                        record_history()
+                    self._n_events += 1
+                callback()
         # after simulation ends, plot the TEC history
-        self.__make_plot()
+        if self.plot:
+            self.__make_plot()
         return
 
-    def __log_state(self, node: CanNode):
-        line = f"[STATE CHANGE] {node.name.upper()} -> {node.state.value} (TEC={node.TEC})"
-        print(line)
-        self.log_f.write(line + "\n")
+    def execute_closed_form(self):
+        """
+        Same run as execute, but the log and the TEC history are computed at once
+        by closed_form.run instead of dispatching the events one by one.
+        Only the text log is supported.
+        """
+        if self.binary_log:
+            raise ValueError("the closed-form run only writes the text log")
+        time, att, dfn, lines = closed_form.run(MAX_ROUNDS, GAP_US,
+                                                self.attacker.name.upper(),
+                                                self.defender.name.upper())
+        with self:
+            if self.verbose:
+                print("\n".join(lines))
+            self._log_buf.append("".join([line + "\n" for line in lines]))
+        # same final state as execute
+        self.rounds = MAX_ROUNDS + 1
+        self.time_us = int(time[-1])
+        self.attacker.TEC = self.defender.TEC = int(att[-1])
+        self.attacker._update_state()
+        self.defender._update_state()
+        interval = self.record_interval
+        if interval > 0:
+            # one history sample per event, kept every record_interval events
+            self._n_events = time.shape[0]
+            self._time = np.ascontiguousarray(time[::interval])
+            self._att = np.ascontiguousarray(att[::interval])
+            self._def = np.ascontiguousarray(dfn[::interval])
+            self._n = self._time.shape[0]
+        if self.plot:
+            self.__make_plot()
+
+    def __log_state(self, *nodes: CanNode):
+        for node in nodes:
+            if self.binary_log:
+                # the record already carries the TEC and the state
+                self.log(f"{STATE_CHANGE} {node.name.upper()}", node)
+            else:
+                self.write_line(state_change_line(node.name.upper(), node.state_str, node.TEC))
 
     def __make_plot(self):
         """
         Plot the TEC history for attacker and defender.
+        The figure is created by the first run and reused by the next ones,
+        which only replace the data of its lines.
         """
-        plt.figure()
-        plt.plot(self.history["time"], self.history["attacker"], marker='o', label="Attacker")
-        plt.plot(self.history["time"], self.history["defender"], marker='s', label="Defender")
-        plt.xlabel("Time (us)")
-        plt.ylabel("Transmit Error Counter (TEC)")
-        plt.title("TEC Evolution: Parrot Experiment 1")
-        plt.legend()
-        plt.grid(True)
+        if CanBus._figure is None:
+            # imported here so runs without a plot don't pay for matplotlib
+            import matplotlib
+            matplotlib.use("Agg") # the plot is only saved to a file
+            import matplotlib.pyplot as plt
+
+            fig, ax = plt.subplots()
+            lines = (ax.plot([], [], marker='o', label="Attacker")[0],
+                     ax.plot([], [], marker='s', label="Defender")[0])
+            ax.set_xlabel("Time (us)")
+            ax.set_ylabel("Transmit Error Counter (TEC)")
+            ax.set_title("TEC Evolution: Parrot Experiment 1")
+            ax.legend()
+            ax.grid(True)
+            CanBus._figure = (fig, ax, lines)
+        fig, ax, (att_line, def_line) = CanBus._figure
+
+        history = self.history
+        # keep the number of markers bounded on long histories
+        markevery = max(1, len(history["time"]) // 100)
+        att_line.set_data(history["time"], history["attacker"])
+        def_line.set_data(history["time"], history["defender"])
+        att_line.set_markevery(markevery)
+        def_line.set_markevery(markevery)
+        ax.relim()
+        ax.autoscale_view()
         # save the plot to a file
         output_file = "plot_1.png"
-        plt.savefig(output_file)
-        print(f"Plot saved to {output_file}")
+        fig.savefig(output_file)
+        if self.verbose:
+            print(f"Plot saved to {output_file}")
 
     # handle the round
     def __start_round(self):
@@ -87,19 +168,17 @@ class CanBus(CanBusBase):
         self.schedule(0, self.__handle_collision)
 
     def __handle_collision(self):
-        # collision snowball until error-passive
-        self.attacker.collide()
-        self.defender.collide()
-        self.__log_state(self.attacker)
-        self.__log_state(self.defender)
+        # collision snowball until error-passive, applied in one go
+        steps = self.collision_snowball(GAP_US)
+        self.log(f"Collision snowball x{steps}")
+        self.__log_state(self.attacker, self.defender)
         if self.attacker.state == ErrorStates.ACTIVE:
             self.schedule(GAP_US, self.__handle_collision)
         else:
             self.schedule(GAP_US, self.__recover_defender)
 
     def __recover_defender(self):
-        self.defender.succeed()
-        self.log("Defender recovers send", self.defender)
+        self._step(self.defender, "Defender recovers send")
         if self.defender.state != ErrorStates.ACTIVE:
             self.schedule(GAP_US, self.__recover_defender)
         else:
@@ -107,8 +186,7 @@ class CanBus(CanBusBase):
             self.schedule(GAP_US, self.__recover_attacker)
 
     def __recover_attacker(self):
-        self.attacker.succeed()
-        self.log("Attacker recovers send", self.attacker)
+        self._step(self.attacker, "Attacker recovers send")
         if self.attacker.state != ErrorStates.ACTIVE:
             self.schedule(GAP_US, self.__recover_attacker)
         else:
@@ -117,4 +195,25 @@ class CanBus(CanBusBase):
 
 # start the execution
 if __name__ == "__main__":
-    CanBus().execute()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="also print the log to the console")
+    parser.add_argument("--no-plot", dest="plot", action="store_false",
+                        help="don't plot the TEC history")
+    parser.add_argument("--binary-log", action="store_true",
+                        help="write a binary log (read it with parrot_project.decode_log)")
+    parser.add_argument("--record-interval", type=int, default=1, metavar="N",
+                        help="record the TEC history every N events (-1: don't record)")
+    parser.add_argument("--closed-form", action="store_true",
+                        help="compute the whole trace at once instead of simulating the events")
+    args = parser.parse_args()
+    if args.record_interval != -1 and args.record_interval < 1:
+        parser.error("--record-interval must be -1 or a positive integer")
+    if args.closed_form and args.binary_log:
+        parser.error("--closed-form only writes the text log")
+    bus = CanBus(verbose=args.verbose, plot=args.plot, binary_log=args.binary_log,
+                 record_interval=args.record_interval)
+    if args.closed_form:
+        bus.execute_closed_form()
+    else:
+        bus.execute()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# run the script: python -m parrot_project.experiment_3.simulate
+# run the script: python -m parrot_project.experiment_3.simulate [-v] [--no-plot] [--binary-log] [--record-interval N]
 """
 Simulate Parrot Experiment 3: defender assisted by neighbor.
 This experiment is run in the same SJA1000 USB adapters, but the difference
@@ -8,21 +8,33 @@ which sends non-spoofed messages, in order to create 'benign traffic'.
 With this help Alice is able to achieve 100% BUS OFF, and actually the script
 runs until the ECUs are bus off
 """
+import argparse
 import heapq
-import matplotlib.pyplot as plt
+import numpy as np
 
 from  ..utils import (
     ErrorStates,
     CanNode,
     CanBusBase,
-    ASSISTANT_GAP_US, ATTACKER_PERIOD_US, GAP_US
+    ASSISTANT_GAP_US, ATTACKER_PERIOD_US, GAP_US,
+    HISTORY_CAPACITY
 )
 
+# gap between the passive-flag collisions, whichever comes first between
+# the next defender retry and the next assistant message
+PASSIVE_GAP_US = min(ASSISTANT_GAP_US, GAP_US)
+
 class CanBus(CanBusBase):
-    def __init__(self):
-        super().__init__(log_file="exp_3.txt")
-        self.assistant = CanNode("[C] ASSISTANT")  # C: Assistant
-        self.history = {"time": [], "attacker": [], "defender": [], "assistant": []}
+    __slots__ = ("plot", "assistant", "_asst")
+    _figure = None # (figure, axes, lines) shared by every run, see __make_plot
+
+    def __init__(self, verbose: bool = False, plot: bool = True, binary_log: bool = False,
+                 record_interval: int = 1):
+        super().__init__(log_file="exp_3.txt", verbose=verbose, binary_log=binary_log,
+                         record_interval=record_interval)
+        self.plot = plot
+        self.assistant = CanNode("[C] ASSISTANT", 2)  # C: Assistant
+        self._asst = np.empty(HISTORY_CAPACITY, dtype=np.int16)
     
     def execute(self):
         # Schedule Attacker’s periodic spoof
@@ -30,37 +42,92 @@ class CanBus(CanBusBase):
         # Schedule Assistant’s continuous AD-messages
         self.schedule(0, self.__assistant_send)
         # Run until no events or Attacker is bus-off
-        while self.events and self.attacker.state != ErrorStates.BUS_OFF:
-            t, _, callback = heapq.heappop(self.events)
-            self.time_us = t
-            self.__record_history()
-            callback()
-        self.log_f.close()
+        # local references for the hot loop
+        heappop = heapq.heappop
+        events = self.events
+        attacker = self.attacker
+        bus_off = ErrorStates.BUS_OFF
+        now = self._now
+        next_now = now.popleft
+        record_history = self.__record_history
+        interval = self.record_interval
+        with self:
+            while (now or events) and attacker.state != bus_off:
+                if not now:
+                    # move on to the next timestamp and queue all its events
+                    t = events[0][0]
+                    self.time_us = t
+                    while events and events[0][0] == t:
+                        now.append(heappop(events)[2])
+                callback = next_now()
+                # record before each event (every record_interval events, -1: never)
+                if interval > 0:
+                    if self._n_events % interval == 0:
+                        record_history()
+                    self._n_events += 1
+                callback()
         # after simulation ends, plot the TEC history
-        self.__make_plot()
+        if self.plot:
+            self.__make_plot()
 
         return
 
+    @property
+    def history(self):
+        history = super().history
+        history["assistant"] = self._asst[:self._n]
+        return history
+
+    def _grow_history(self):
+        super()._grow_history()
+        self._asst = np.resize(self._asst, self._time.shape[0])
+
+    def record_collision_ramp(self, steps: int, gap_us: int):
+        n = self._n
+        super().record_collision_ramp(steps, gap_us)
+        # the assistant is not involved in the snowball
+        self._asst[n:self._n] = self.assistant.TEC
+
     def __record_history(self):
         self.record_history()
-        self.history["assistant"].append(self.assistant.TEC)
+        self._asst[self._n - 1] = self.assistant.TEC
 
     def __make_plot(self):
         """
         Plot the TEC history for attacker, defender and assistant.
+        The figure is created by the first run and reused by the next ones,
+        which only replace the data of its lines.
         """
-        plt.figure()
-        plt.plot(self.history["time"], self.history["attacker"],   marker='o', label="[E]")
-        plt.plot(self.history["time"], self.history["defender"], marker='s', label="[A]")
-        plt.plot(self.history["time"], self.history["assistant"], marker='^', label="[C]")
-        plt.xlabel("Time (us)")
-        plt.ylabel("Transmit Error Counter (TEC)")
-        plt.title("TEC Evolution: Parrot Experiment 3")
-        plt.legend()
-        plt.grid(True)
+        if CanBus._figure is None:
+            # imported here so runs without a plot don't pay for matplotlib
+            import matplotlib
+            matplotlib.use("Agg") # the plot is only saved to a file
+            import matplotlib.pyplot as plt
+
+            fig, ax = plt.subplots()
+            lines = (ax.plot([], [], marker='o', label="[E]")[0],
+                     ax.plot([], [], marker='s', label="[A]")[0],
+                     ax.plot([], [], marker='^', label="[C]")[0])
+            ax.set_xlabel("Time (us)")
+            ax.set_ylabel("Transmit Error Counter (TEC)")
+            ax.set_title("TEC Evolution: Parrot Experiment 3")
+            ax.legend()
+            ax.grid(True)
+            CanBus._figure = (fig, ax, lines)
+        fig, ax, lines = CanBus._figure
+
+        history = self.history
+        # keep the number of markers bounded on long histories
+        markevery = max(1, len(history["time"]) // 100)
+        for line, key in zip(lines, ("attacker", "defender", "assistant")):
+            line.set_data(history["time"], history[key])
+            line.set_markevery(markevery)
+        ax.relim()
+        ax.autoscale_view()
         output_file = "plot_3.png"
-        plt.savefig(output_file)
-        print(f"Plot saved to {output_file}")
+        fig.savefig(output_file)
+        if self.verbose:
+            print(f"Plot saved to {output_file}")
 
     def __send_attack(self):
         self.log("[Attacker] sends spoofed frame", self.attacker)
@@ -69,18 +136,17 @@ class CanBus(CanBusBase):
             self.schedule(ATTACKER_PERIOD_US, self.__send_attack)
 
     def __handle_collision(self):
-        self.attacker.collide()
-        self.log("[Attacker] collision bit-error", self.attacker)
-        self.defender.collide()
-        self.log("[Defender] collision bit-error", self.defender)
+        # collisions up to error-passive (or up to the next assistant message)
+        steps = self.collision_snowball(GAP_US)
+        self.log(f"[Attacker] collisions x{steps}", self.attacker)
+        self.log(f"[Defender] collisions x{steps}", self.defender)
         if self.attacker.state == ErrorStates.ACTIVE:
             self.schedule(GAP_US, self.__handle_collision)
         else:
             self.schedule(GAP_US, self.__recover_defender)
 
     def __recover_defender(self):
-        self.defender.succeed()
-        self.log("[Defender] recovers send", self.defender)
+        self._step(self.defender, "[Defender] recovers send")
         if self.defender.state != ErrorStates.ACTIVE:
             self.schedule(GAP_US, self.__recover_defender)
         else:
@@ -88,11 +154,9 @@ class CanBus(CanBusBase):
             self.schedule(0, self.__collide_passive)
 
     def __collide_passive(self):
-        self.attacker.collide()
-        self.log("[Attacker] passive-flag collision", self.attacker)
+        self._step(self.attacker, "[Attacker] passive-flag collision", collide=True)
         if self.attacker.state != ErrorStates.BUS_OFF:
-            next_gap = min(ASSISTANT_GAP_US, GAP_US)
-            self.schedule(next_gap, self.__collide_passive)
+            self.schedule(PASSIVE_GAP_US, self.__collide_passive)
         else:
             self.log("[Attacker] bus-off reached", self.attacker)
 
@@ -103,4 +167,17 @@ class CanBus(CanBusBase):
 
 # start execution
 if __name__ == "__main__":
-    CanBus().execute()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="also print the log to the console")
+    parser.add_argument("--no-plot", dest="plot", action="store_false",
+                        help="don't plot the TEC history")
+    parser.add_argument("--binary-log", action="store_true",
+                        help="write a binary log (read it with parrot_project.decode_log)")
+    parser.add_argument("--record-interval", type=int, default=1, metavar="N",
+                        help="record the TEC history every N events (-1: don't record)")
+    args = parser.parse_args()
+    if args.record_interval != -1 and args.record_interval < 1:
+        parser.error("--record-interval must be -1 or a positive integer")
+    CanBus(verbose=args.verbose, plot=args.plot, binary_log=args.binary_log,
+           record_interval=args.record_interval).execute()
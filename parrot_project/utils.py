@@ -5,11 +5,20 @@ It contains some constants and other classes such as ErrorStates, CanNode, and C
 
 To schedule and dispatch the events we used heapq, which handles
 collision retries, recovery sends, round starts in chronological order.
+Events due at the current time skip the heap and wait in a FIFO deque.
 """
 import os
+from collections import deque
 from enum import Enum
 import heapq
-import matplotlib.pyplot as plt
+import itertools
+import struct
+import numpy as np
+
+# bound once so the scheduler doesn't look it up on the heapq module every push
+_push = heapq.heappush
+# running counter used as the heap tie-breaker (see CanBusBase.schedule)
+_tiebreak = itertools.count()
 
 # Gaps in microseconds
 GAP_US = 31 # Defender’s D-frame gap (SJA1000 max speed), Alice can't send msgs more frequently because this gap is required 
@@ -18,67 +27,180 @@ MAX_ROUNDS = 3 # number of attack/recovery cycles (chosen for test)
 ASSISTANT_GAP_US   = 200       # Assistant’s AD-message gap (~200µs)
 ATTACKER_PERIOD_US = 1_000_000 # Attacker’s spoof period (1 s)
 
+# Log files (relative to the working directory)
+LOGS_DIR = "logs"
+
+# Log buffering
+LOG_FLUSH_LINES = 1024 # number of buffered lines before writing them out
+
+# Log format
+LOG_HEADER = "TIME (us)   |  EVENT                          | TEC/STATE"
+# binary log record: time_us, TEC, state id, node id, event (utf-8, NUL padded)
+LOG_EVENT_BYTES = 40 # longest event of a record, once encoded
+LOG_RECORD = struct.Struct(f"<QHBB{LOG_EVENT_BYTES}s")
+NO_NODE = 255 # node id of the records that are not about a node
+STATE_CHANGE = "[STATE CHANGE]" # event prefix of the state change lines
+
+# initial number of samples in the TEC history arrays (doubled when full)
+HISTORY_CAPACITY = 1024
+
 # Error states
 class ErrorStates(Enum):
     ACTIVE = "ACTIVE"
     ERROR_PASSIVE = "PASSIVE"
     BUS_OFF = "BUS-OFF"
 
+# module-level aliases so the hot state update skips the Enum class lookup
+_ACTIVE = ErrorStates.ACTIVE
+_ERROR_PASSIVE = ErrorStates.ERROR_PASSIVE
+_BUS_OFF = ErrorStates.BUS_OFF
+# state ids used in the binary log (index in ErrorStates)
+STATES = tuple(ErrorStates)
+_STATE_IDS = {state: i for i, state in enumerate(STATES)}
+
 # CAN node refers to the ECU entities (Attacker/Defender/Assistant)
 class CanNode:
-    def __init__(self, name: str):
+    __slots__ = ("name", "node_id", "TEC", "state", "state_str", "_info", "_info_tec")
+
+    def __init__(self, name: str, node_id: int = NO_NODE):
         self.name = name
+        self.node_id = node_id # identifies the node in the binary log
         self.TEC = 0
         self.state = ErrorStates.ACTIVE
+        self.state_str = self.state.value # state.value, kept in sync by _update_state
+        # "TEC/STATE" log column, rebuilt only when the TEC changes (see CanBusBase.format_line)
+        self._info = ""
+        self._info_tec = None
 
-    def collide(self):
-        # Increases the transmit error counter by 8
+    def collide(self, times: int = 1):
+        # Increases the transmit error counter by 8 for each collision
         # and updates the ECU's state.
-        self.TEC += 8
-        self._update_state()
+        # The TEC only grows here, so below 128 the node stays ACTIVE.
+        tec = self.TEC + 8 * times
+        self.TEC = tec
+        if tec >= 128:
+            self._update_state()
 
     def succeed(self):
         # Decreases the transmit error counter by 1
         # and updates the ECU's state.
-        if self.TEC > 0:
-            self.TEC -= 1
-        self._update_state()
+        # Going down by one, the state can only change when crossing 128 or 256.
+        tec = self.TEC
+        if tec > 0:
+            tec -= 1
+            self.TEC = tec
+            if tec == 127 or tec == 255:
+                self._update_state()
 
     def _update_state(self):
-        if self.TEC >= 256:
-            self.state = ErrorStates.BUS_OFF
-        elif self.TEC >= 128:
-            self.state = ErrorStates.ERROR_PASSIVE
-        else:
-            self.state = ErrorStates.ACTIVE
+        # The state follows from the TEC: ACTIVE below 128,
+        # ERROR_PASSIVE below 256, BUS_OFF from there on.
+        tec = self.TEC
+        state = _BUS_OFF if tec >= 256 else (_ERROR_PASSIVE if tec >= 128 else _ACTIVE)
+        if state is not self.state:
+            self.state = state
+            self.state_str = state.value
+
+
+# Text log formatting, shared by CanBusBase and decode_log
+def log_time(time_us: int) -> str:
+    """
+    Timestamp column of a text log line.
+    """
+    return (str(time_us) + "us").rjust(12)
+
+def log_info(tec: int, state: str) -> str:
+    """
+    TEC/STATE column of a text log line.
+    """
+    return f"TEC:{tec} [{state}]"
+
+def log_event(event: str, info: str = None) -> str:
+    """
+    Rest of a text log line after the timestamp: event and TEC/STATE column (if any).
+    """
+    if info:
+        return "".join((" | ", event.ljust(30), " | ", info))
+    return " | " + event
+
+def state_change_line(name: str, state: str, tec: int) -> str:
+    """
+    Text log line (without timestamp) reporting the new state of a node.
+    """
+    return f"{STATE_CHANGE} {name} -> {state} (TEC={tec})"
+
+def record_line(time_us: int, event: str, tec: int = None, state: str = None) -> str:
+    """
+    Text log line of a binary log record, tec and state being None when the
+    record is not about a node. Used by the verbose console in binary mode and
+    by decode_log, so both print the same lines as the text log.
+    """
+    if tec is None:
+        return log_time(time_us) + log_event(event)
+    if event.startswith(STATE_CHANGE):
+        # state change records only carry the node name after the prefix,
+        # and the text log writes them without the time column
+        return state_change_line(event[len(STATE_CHANGE) + 1:], state, tec)
+    return log_time(time_us) + log_event(event, log_info(tec, state))
 
 
 # Can Bus Base class, extended by the ex 1 and ex3 classes
 class CanBusBase:
-    def __init__(self, log_file):
+    # subclasses declare __slots__ for the attributes they add
+    __slots__ = ("verbose", "time_us", "events", "_now", "rounds",
+                 "attacker", "defender", "_time", "_att", "_def", "_n",
+                 "binary_log", "log_f", "_log_buf", "record_interval", "_n_events")
+
+    def __init__(self, log_file, verbose: bool = False, binary_log: bool = False,
+                 record_interval: int = 1):
+        # when verbose, every log line is also printed to the console
+        self.verbose = verbose
+        # when binary_log, log() writes fixed-size LOG_RECORD records to a .bin
+        # file instead of text lines (see decode_log.py to read them back)
+        self.binary_log = binary_log
         self.time_us = 0
-        self.events = []
-        self.counter = 0
+        self.events = []    # heap of future events
+        self._now = deque() # callbacks due at the current time, in FIFO order
         self.rounds = 0 # -----
         
         # create nodes (ECU simulation)
-        self.attacker = CanNode("[E] ATTACKER")   # E: Attacker
-        self.defender = CanNode("[A] DEFENDER")   # A: Defender
-        # record TEC history
-        self.history = {"time": [], "attacker": [], "defender": []}
-
-        # make a log dir and set the log file up
-        logs_dir = "logs"
-        os.makedirs(logs_dir, exist_ok=True)
-        full_path = os.path.join(logs_dir, log_file)
+        self.attacker = CanNode("[E] ATTACKER", 0)   # E: Attacker
+        self.defender = CanNode("[A] DEFENDER", 1)   # A: Defender
+        # record TEC history, one numpy array per column and
+        # self._n samples filled so far (see record_history)
+        self._time = np.empty(HISTORY_CAPACITY, dtype=np.int64)
+        self._att = np.empty(HISTORY_CAPACITY, dtype=np.int16)
+        self._def = np.empty(HISTORY_CAPACITY, dtype=np.int16)
+        self._n = 0
+        # the TEC history is sampled every record_interval events
+        # (-1 disables it), self._n_events counts the events seen so far
+        record_interval = int(record_interval)
+        if record_interval != -1 and record_interval < 1:
+            raise ValueError(f"record_interval must be -1 or a positive integer, got {record_interval}")
+        self.record_interval = record_interval
+        self._n_events = 0
 
-        self.log_f = open(full_path, "w", encoding="utf-8")
-        header = "TIME (us)   |  EVENT                          | TEC/STATE"
-        sep = "-" * len(header)
-        print(header)
-        print(sep)
+        # set the log file up
+        if binary_log:
+            log_file = os.path.splitext(log_file)[0] + ".bin"
+        full_path = os.path.join(LOGS_DIR, log_file)
 
-        self.log_f.write(header + "\n" + sep + "\n")
+        # log lines (or records) are kept in memory and written out in batches
+        # (see flush_log), so the file itself is unbuffered
+        self._log_buf: list = []
+        try:
+            self.log_f = open(full_path, "wb", buffering=0)
+        except FileNotFoundError:
+            # the log dir is only created when missing, not checked on every run
+            os.makedirs(LOGS_DIR, exist_ok=True)
+            self.log_f = open(full_path, "wb", buffering=0)
+        if binary_log:
+            if verbose:
+                print(LOG_HEADER)
+                print("-" * len(LOG_HEADER))
+        else:
+            self.write_line(LOG_HEADER)
+            self.write_line("-" * len(LOG_HEADER))
 
     def schedule(self, delay_us: int, callback):
         """
@@ -86,28 +208,187 @@ class CanBusBase:
         #note: time_us means time in micro seconds (us -> microseconds)
         Internally, uses a heapq-based priority queue (`self.events`) where each event is stored
         as a tuple (event_time, order, callback). `event_time` is the simulated timestamp
-        (current time_us + delay_us), and `order` (self.counter) is a running counter used as a
+        (current time_us + delay_us), and `order` (next(_tiebreak)) is a running counter used as a
         tie-breaker so that events scheduled for the same timestamp execute in FIFO order.
         The `callback` is the function to invoke when the event fires.
+        Events with no delay don't go through the heap: they are appended to the
+        `self._now` deque, which the execute loop drains before moving on in time.
+        The loop moves every heap event of the next timestamp to `self._now`
+        at once, so the FIFO order between same-time events is preserved.
+        """
+        if delay_us == 0:
+            self._now.append(callback)
+        else:
+            event_time = self.time_us + delay_us
+            _push(self.events, (event_time, next(_tiebreak), callback))
+
+    def collision_snowball(self, gap_us: int) -> int:
+        """
+        Apply a run of attacker/defender collisions, one every gap_us, in one go.
+        The retries are deterministic (+8 TEC each), so instead of scheduling one
+        event per retry we apply as many as are needed to put the attacker in
+        ERROR_PASSIVE (TEC >= 128), but stop before the next scheduled event so that
+        it still sees the same TEC values it would have seen.
+        time_us is moved forward to the last applied collision.
+        The history samples of the skipped retries are filled in by
+        record_collision_ramp, so the plot is the same as with one event per retry.
+        Returns the number of collisions applied (at least 1).
         """
-        event_time = self.time_us + delay_us
-        heapq.heappush(self.events, (event_time, self.counter, callback))
-        self.counter += 1
+        steps = max(1, -(-(128 - self.attacker.TEC) // 8))
+        if self._now:
+            steps = 1
+        elif self.events:
+            steps = min(steps, max(1, -(-(self.events[0][0] - self.time_us) // gap_us)))
+        self.record_collision_ramp(steps, gap_us)
+        self.attacker.collide(steps)
+        self.defender.collide(steps)
+        self.time_us += (steps - 1) * gap_us
+        return steps
+
+    def _step(self, node: CanNode, event: str, collide: bool = False):
+        """
+        Apply one transmission outcome to node and log event with its new TEC/STATE.
+        A collision adds 8 to the TEC, a success takes 1 off (down to 0).
+        Fuses node.collide()/node.succeed() and log() into a single call, since
+        every recovery or passive collision event does exactly that.
+        """
+        if collide:
+            node.collide()
+        else:
+            node.succeed()
+        self.log(event, node)
 
     def log(self, event: str, node: CanNode=None):
-        ts = f"{self.time_us}us"
+        if self.binary_log:
+            self.write_record(event, node)
+            if self.verbose:
+                if node:
+                    print(record_line(self.time_us, event, node.TEC, node.state_str))
+                else:
+                    print(record_line(self.time_us, event))
+        else:
+            self.write_line(self.format_line(event, node))
+
+    def format_line(self, event: str, node: CanNode=None) -> str:
+        """
+        Format a text log line: time, event and the TEC/STATE of node (if any).
+        """
+        if node:
+            # the state follows from the TEC, so the column only changes with it
+            if node._info_tec != node.TEC:
+                node._info = log_info(node.TEC, node.state_str)
+                node._info_tec = node.TEC
+            return log_time(self.time_us) + log_event(event, node._info)
+        return log_time(self.time_us) + log_event(event)
+
+    def write_line(self, line: str):
+        """
+        Append a line to the in-memory log buffer, writing the buffer
+        to the log file every LOG_FLUSH_LINES lines.
+        The line is printed to the console only in verbose mode.
+        """
+        if self.verbose:
+            print(line)
+        self._log_buf.append(line + "\n")
+        if len(self._log_buf) >= LOG_FLUSH_LINES:
+            self.flush_log()
+
+    def write_record(self, event: str, node: CanNode=None):
+        """
+        Append a binary LOG_RECORD to the in-memory log buffer, writing the buffer
+        to the log file every LOG_FLUSH_LINES records.
+        Raises ValueError if the encoded event is longer than LOG_EVENT_BYTES,
+        since pack() would cut it (possibly inside a UTF-8 character).
+        """
+        data = event.encode("utf-8")
+        if len(data) > LOG_EVENT_BYTES:
+            raise ValueError(f"log event longer than {LOG_EVENT_BYTES} bytes: {event!r}")
         if node:
-            info = f"TEC:{node.TEC} [{node.state.value}]"
-            line = f"{ts:>12} | {event:<30} | {info}"
+            record = LOG_RECORD.pack(self.time_us, node.TEC, _STATE_IDS[node.state],
+                                     node.node_id, data)
         else:
-            line = f"{ts:>12} | {event}"
-        print(line)
-        self.log_f.write(line + "\n")
+            record = LOG_RECORD.pack(self.time_us, 0, 0, NO_NODE, data)
+        self._log_buf.append(record)
+        if len(self._log_buf) >= LOG_FLUSH_LINES:
+            self.flush_log()
+
+    def flush_log(self):
+        """
+        Write all the buffered lines (or records) to the log file in one go.
+        """
+        if self.binary_log:
+            data = b"".join(self._log_buf)
+        else:
+            data = "".join(self._log_buf).encode("utf-8")
+        self._log_buf.clear()
+        # the file is unbuffered, so a write may be partial
+        view = memoryview(data)
+        while view:
+            view = view[self.log_f.write(view):]
+
+    def close_log(self):
+        """
+        Flush the remaining buffered lines and close the log file.
+        """
+        self.flush_log()
+        self.log_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # the log is flushed and closed even if the simulation fails
+        self.close_log()
+
+    @property
+    def history(self):
+        """
+        Recorded TEC history as a dict of numpy arrays (views, no copy).
+        """
+        n = self._n
+        return {"time": self._time[:n], "attacker": self._att[:n], "defender": self._def[:n]}
+
+    def _grow_history(self):
+        """
+        Double the capacity of the history arrays.
+        """
+        size = 2 * self._time.shape[0]
+        self._time = np.resize(self._time, size)
+        self._att = np.resize(self._att, size)
+        self._def = np.resize(self._def, size)
+
+    def record_collision_ramp(self, steps: int, gap_us: int):
+        """
+        Record the TEC history for the retries 1..steps-1 of a collision snowball
+        starting now (retry 0 is recorded by the execute loop), computed in closed
+        form: retry i happens at time_us + i*gap_us, after i collisions (+8 each).
+        Each retry counts as an event for record_interval.
+        """
+        interval = self.record_interval
+        if steps <= 1 or interval <= 0:
+            return
+        i = np.arange(1, steps)
+        if interval > 1:
+            # retry 0 was event self._n_events - 1, keep the sampled retries only
+            i = i[(self._n_events - 1 + i) % interval == 0]
+        self._n_events += steps - 1
+        k = len(i)
+        n = self._n
+        while n + k > self._time.shape[0]:
+            self._grow_history()
+        self._time[n:n + k] = self.time_us + i * gap_us
+        self._att[n:n + k] = self.attacker.TEC + 8 * i
+        self._def[n:n + k] = self.defender.TEC + 8 * i
+        self._n = n + k
 
     def record_history(self):
         """
         Record current TEC values of attacker and defender at the current time.
         """
-        self.history["time"].append(self.time_us)
-        self.history["attacker"].append(self.attacker.TEC)
-        self.history["defender"].append(self.defender.TEC)
+        n = self._n
+        if n == self._time.shape[0]:
+            self._grow_history()
+        self._time[n] = self.time_us
+        self._att[n] = self.attacker.TEC
+        self._def[n] = self.defender.TEC
+        self._n = n + 1